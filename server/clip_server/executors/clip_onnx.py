@@ -1,11 +1,17 @@
+import asyncio
 import os
 import warnings
 from multiprocessing.pool import ThreadPool
 from typing import Optional, Dict
 
+import numpy as np
 import onnxruntime as ort
 from clip_server.executors.helper import (
-    split_img_txt_da,
+    DynamicBatcher,
+    create_preproc_executor,
+    pad_batch,
+    prefetch_map_batch,
+    split_img_txt_docs,
     preproc_image,
     preproc_text,
     set_rank,
@@ -22,9 +28,13 @@ class CLIPEncoder(Executor):
         name: str = 'ViT-B-32::openai',
         device: Optional[str] = None,
         num_worker_preprocess: int = 4,
+        preprocess_backend: str = 'thread',
         minibatch_size: int = 32,
         access_paths: str = '@r',
         model_path: Optional[str] = None,
+        quantize: bool = False,
+        use_tensorrt: bool = False,
+        batch_timeout_ms: Optional[float] = None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -42,7 +52,10 @@ class CLIPEncoder(Executor):
         self._model = CLIPOnnxModel(name, model_path)
         self._tokenizer = Tokenizer(name)
 
-        self._image_transform = clip._transform_ndarray(self._model.image_size)
+        self._image_transform = clip._transform_ndarray_crop(self._model.image_size)
+        self._preproc_executor = create_preproc_executor(
+            preprocess_backend, num_worker_preprocess, self._model.image_size
+        )
 
         import torch
 
@@ -51,19 +64,70 @@ class CLIPEncoder(Executor):
         else:
             self._device = device
 
+        if quantize:
+            if self._device.startswith('cuda'):
+                warnings.warn(
+                    f'int8 quantization is only supported on CPU, ignored on {self._device}.'
+                )
+            else:
+                self._model.quantize()
+
         # define the priority order for the execution providers
         providers = ['CPUExecutionProvider']
 
         # prefer CUDA Execution Provider over CPU Execution Provider
         if self._device.startswith('cuda'):
-            providers.insert(0, 'CUDAExecutionProvider')
+            device_id = int(self._device.split(':')[1]) if ':' in self._device else 0
+            cuda_options = {
+                'device_id': device_id,
+                'arena_extend_strategy': 'kNextPowerOfTwo',
+                # benchmark all the cuDNN conv algorithms once per shape, the shapes are fixed by the
+                # minibatch padding and the search is paid by the warmup
+                'cudnn_conv_algo_search': 'EXHAUSTIVE',
+                'do_copy_in_default_stream': True,
+                'cudnn_conv_use_max_workspace': '1',
+            }
+            if not use_tensorrt:
+                # capture the kernels once and replay them for the fixed-shape minibatches, which requires all the
+                # nodes on the CUDA Execution Provider, i.e. none taken by TensorRT
+                cuda_options['enable_cuda_graph'] = '1'
+            providers.insert(0, ('CUDAExecutionProvider', cuda_options))
+
+            # prefer TensorRT Execution Provider over CUDA Execution Provider, the unsupported nodes fall back to CUDA
+            if use_tensorrt:
+                providers.insert(
+                    0,
+                    (
+                        'TensorrtExecutionProvider',
+                        {
+                            'device_id': device_id,
+                            'trt_fp16_enable': True,
+                            'trt_max_workspace_size': 4 * 1024**3,
+                            # persist the compiled engines to skip the building on the next start
+                            'trt_engine_cache_enable': True,
+                            'trt_engine_cache_path': os.path.expanduser(
+                                '~/.cache/clip/tensorrt'
+                            ),
+                        },
+                    ),
+                )
 
         sess_options = ort.SessionOptions()
 
-        # Enables all available optimizations including layout optimizations
-        sess_options.graph_optimization_level = (
-            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-        )
+        if self._device.startswith('cuda'):
+            # The layout optimizations of `ORT_ENABLE_ALL` only target CPU, and may insert Memcpy nodes on GPU
+            sess_options.graph_optimization_level = (
+                ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+            )
+
+            # The host allocations are few with the CUDA Execution Provider, no need of the CPU arena and mem pattern
+            sess_options.enable_cpu_mem_arena = False
+            sess_options.enable_mem_pattern = False
+        else:
+            # Enables all available optimizations including layout optimizations
+            sess_options.graph_optimization_level = (
+                ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            )
 
         if not self._device.startswith('cuda') and (
             'OMP_NUM_THREADS' not in os.environ
@@ -84,15 +148,79 @@ class CLIPEncoder(Executor):
             sess_options.inter_op_num_threads = 1
             sess_options.intra_op_num_threads = max(num_threads, 1)
 
-        self._model.start_sessions(sess_options=sess_options, providers=providers)
+        self._model.start_sessions(
+            minibatch_size=self._minibatch_size,
+            sess_options=sess_options,
+            providers=providers,
+        )
+
+        # NOTE: ORT falls back to the CPU Execution Provider if the CUDA one can not be loaded, hence whether the
+        # inputs stay on GPU is decided by the sessions rather than by `device`
+        self._on_gpu = self._model.use_io_binding
+
+        # on GPU the short last minibatch is padded, so that the kernels tuned for (and the TensorRT engine
+        # built for) the shape of a full minibatch are reused
+        self._pad_batches = self._on_gpu
+
+        # batch the docs across the concurrent requests, waiting at most `batch_timeout_ms` for a full minibatch
+        self._batchers = None
+        if batch_timeout_ms is not None:
+            self._batchers = {
+                'image': DynamicBatcher(
+                    self._encode_images,
+                    batch_size=minibatch_size,
+                    timeout=batch_timeout_ms / 1000,
+                ),
+                'text': DynamicBatcher(
+                    self._encode_texts,
+                    batch_size=minibatch_size,
+                    timeout=batch_timeout_ms / 1000,
+                ),
+            }
+
+        self._warmup()
+
+    def _warmup(self):
+        # run one dummy minibatch through both sessions, so the kernel selection (and the TensorRT engine build)
+        # is paid before serving rather than by the first request
+        self._model.encode_image(
+            {
+                'pixel_values': np.zeros(
+                    (
+                        self._minibatch_size,
+                        3,
+                        self._model.image_size,
+                        self._model.image_size,
+                    ),
+                    dtype=np.float32,
+                )
+            }
+        )
+
+        text_inputs = self._tokenizer([''] * self._minibatch_size)
+        self._model.encode_text(
+            {k: v.numpy().astype(np.int32) for k, v in text_inputs.items()}
+        )
+
+    def close(self):
+        for batcher in (self._batchers or {}).values():
+            batcher.close()
+        if self._preproc_executor is not None:
+            self._preproc_executor.shutdown()
+        super().close()
 
     def _preproc_images(self, docs: 'DocumentArray'):
         with self.monitor(
             name='preprocess_images_seconds',
             documentation='images preprocess time in seconds',
         ):
+            # keep the pixel values on device, they are bound to the ONNX session via IOBinding
             return preproc_image(
-                docs, preprocess_fn=self._image_transform, return_np=True
+                docs,
+                preprocess_fn=self._image_transform,
+                device=self._device,
+                executor=self._preproc_executor,
+                return_np=not self._on_gpu,
             )
 
     def _preproc_texts(self, docs: 'DocumentArray'):
@@ -102,6 +230,38 @@ class CLIPEncoder(Executor):
         ):
             return preproc_text(docs, tokenizer=self._tokenizer, return_np=True)
 
+    def _encode_images(self, docs: 'DocumentArray'):
+        for minibatch, batch_data in prefetch_map_batch(
+            docs,
+            self._preproc_images,
+            batch_size=self._minibatch_size,
+            pool=self._pool,
+        ):
+            with self.monitor(
+                name='encode_images_seconds',
+                documentation='images encode time in seconds',
+            ):
+                if self._pad_batches:
+                    batch_data = pad_batch(batch_data, self._minibatch_size)
+                embeddings = self._model.encode_image(batch_data)
+                minibatch.embeddings = embeddings[: len(minibatch)]
+
+    def _encode_texts(self, docs: 'DocumentArray'):
+        for minibatch, batch_data in prefetch_map_batch(
+            docs,
+            self._preproc_texts,
+            batch_size=self._minibatch_size,
+            pool=self._pool,
+        ):
+            with self.monitor(
+                name='encode_texts_seconds',
+                documentation='texts encode time in seconds',
+            ):
+                if self._pad_batches:
+                    batch_data = pad_batch(batch_data, self._minibatch_size)
+                embeddings = self._model.encode_text(batch_data)
+                minibatch.embeddings = embeddings[: len(minibatch)]
+
     @requests(on='/rank')
     async def rank(self, docs: 'DocumentArray', parameters: Dict, **kwargs):
         await self.encode(docs['@r,m'])
@@ -117,35 +277,30 @@ class CLIPEncoder(Executor):
             )
             access_paths = parameters['traversal_paths']
 
-        _img_da = DocumentArray()
-        _txt_da = DocumentArray()
-        for d in docs[access_paths]:
-            split_img_txt_da(d, _img_da, _txt_da)
-
-        # for image
-        if _img_da:
-            for minibatch, batch_data in _img_da.map_batch(
-                self._preproc_images,
-                batch_size=self._minibatch_size,
-                pool=self._pool,
-            ):
-                with self.monitor(
-                    name='encode_images_seconds',
-                    documentation='images encode time in seconds',
-                ):
-                    minibatch.embeddings = self._model.encode_image(batch_data)
-
-        # for text
-        if _txt_da:
-            for minibatch, batch_data in _txt_da.map_batch(
-                self._preproc_texts,
-                batch_size=self._minibatch_size,
-                pool=self._pool,
-            ):
-                with self.monitor(
-                    name='encode_texts_seconds',
-                    documentation='texts encode time in seconds',
-                ):
-                    minibatch.embeddings = self._model.encode_text(batch_data)
+        _img_da, _txt_da = split_img_txt_docs(docs[access_paths])
+
+        if self._batchers:
+            await asyncio.gather(
+                *(
+                    self._batchers[modality].encode(da)
+                    for modality, da in (('image', _img_da), ('text', _txt_da))
+                    if da
+                )
+            )
+        elif _img_da and _txt_da and self._on_gpu:
+            # the visual and textual sessions are independent, hence they are run concurrently
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(
+                loop.run_in_executor(None, self._encode_images, _img_da),
+                loop.run_in_executor(None, self._encode_texts, _txt_da),
+            )
+        else:
+            # for image
+            if _img_da:
+                self._encode_images(_img_da)
+
+            # for text
+            if _txt_da:
+                self._encode_texts(_txt_da)
 
         return docs
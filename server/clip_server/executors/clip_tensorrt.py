@@ -2,9 +2,11 @@ import warnings
 from multiprocessing.pool import ThreadPool
 from typing import Optional, Dict
 
-import numpy as np
 from clip_server.executors.helper import (
-    split_img_txt_da,
+    create_preproc_executor,
+    prefetch_map_batch,
+    split_img_txt_docs,
+    tensor_to_numpy,
     preproc_image,
     preproc_text,
     set_rank,
@@ -21,6 +23,7 @@ class CLIPEncoder(Executor):
         name: str = 'ViT-B-32::openai',
         device: str = 'cuda',
         num_worker_preprocess: int = 4,
+        preprocess_backend: str = 'thread',
         minibatch_size: int = 32,
         access_paths: str = '@r',
         **kwargs,
@@ -55,7 +58,15 @@ class CLIPEncoder(Executor):
         self._model.start_engines()
 
         self._tokenizer = Tokenizer(name)
-        self._image_transform = clip._transform_ndarray(self._model.image_size)
+        self._image_transform = clip._transform_ndarray_crop(self._model.image_size)
+        self._preproc_executor = create_preproc_executor(
+            preprocess_backend, num_worker_preprocess, self._model.image_size
+        )
+
+    def close(self):
+        if self._preproc_executor is not None:
+            self._preproc_executor.shutdown()
+        super().close()
 
     def _preproc_images(self, docs: 'DocumentArray'):
         with self.monitor(
@@ -66,6 +77,7 @@ class CLIPEncoder(Executor):
                 docs,
                 preprocess_fn=self._image_transform,
                 device=self._device,
+                executor=self._preproc_executor,
                 return_np=False,
             )
 
@@ -93,14 +105,12 @@ class CLIPEncoder(Executor):
             )
             access_paths = parameters['traversal_paths']
 
-        _img_da = DocumentArray()
-        _txt_da = DocumentArray()
-        for d in docs[access_paths]:
-            split_img_txt_da(d, _img_da, _txt_da)
+        _img_da, _txt_da = split_img_txt_docs(docs[access_paths])
 
         # for image
         if _img_da:
-            for minibatch, batch_data in _img_da.map_batch(
+            for minibatch, batch_data in prefetch_map_batch(
+                _img_da,
                 self._preproc_images,
                 batch_size=self._minibatch_size,
                 pool=self._pool,
@@ -109,17 +119,14 @@ class CLIPEncoder(Executor):
                     name='encode_images_seconds',
                     documentation='images encode time in seconds',
                 ):
-                    minibatch.embeddings = (
+                    minibatch.embeddings = tensor_to_numpy(
                         self._model.encode_image(batch_data)
-                        .detach()
-                        .cpu()
-                        .numpy()
-                        .astype(np.float32)
                     )
 
         # for text
         if _txt_da:
-            for minibatch, batch_data in _txt_da.map_batch(
+            for minibatch, batch_data in prefetch_map_batch(
+                _txt_da,
                 self._preproc_texts,
                 batch_size=self._minibatch_size,
                 pool=self._pool,
@@ -128,12 +135,8 @@ class CLIPEncoder(Executor):
                     name='encode_texts_seconds',
                     documentation='texts encode time in seconds',
                 ):
-                    minibatch.embeddings = (
+                    minibatch.embeddings = tensor_to_numpy(
                         self._model.encode_text(batch_data)
-                        .detach()
-                        .cpu()
-                        .numpy()
-                        .astype(np.float32)
                     )
 
         return docs
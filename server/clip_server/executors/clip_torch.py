@@ -1,12 +1,22 @@
+import asyncio
 import os
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from multiprocessing.pool import ThreadPool
 from typing import Optional, Dict
 
 import numpy as np
 import torch
 from clip_server.executors.helper import (
-    split_img_txt_da,
+    DynamicBatcher,
+    create_preproc_executor,
+    pad_batch,
+    prefetch_map_batch,
+    split_img_txt_docs,
+    tensor_to_numpy,
     preproc_image,
     preproc_text,
     set_rank,
@@ -24,8 +34,10 @@ class CLIPEncoder(Executor):
         device: Optional[str] = None,
         jit: bool = False,
         num_worker_preprocess: int = 4,
+        preprocess_backend: str = 'thread',
         minibatch_size: int = 32,
         access_paths: str = '@r',
+        batch_timeout_ms: Optional[float] = None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -64,7 +76,123 @@ class CLIPEncoder(Executor):
 
         self._model = CLIPModel(name, device=self._device, jit=jit, **kwargs)
         self._tokenizer = Tokenizer(name)
-        self._image_transform = clip._transform_ndarray(self._model.image_size)
+        # the TorchScript archives of the OpenAI models only accept texts padded to the full context length
+        self._pad_to_longest = not jit
+        self._image_transform = clip._transform_ndarray_crop(self._model.image_size)
+        self._preproc_executor = create_preproc_executor(
+            preprocess_backend, num_worker_preprocess, self._model.image_size
+        )
+
+        # page-locked host buffers for copying the embeddings back from GPU, keyed by the modality
+        self._host_buffers = {}
+        # a modality is encoded by one thread at a time, as its host buffer and CUDA stream are shared
+        self._encode_locks = {'image': threading.Lock(), 'text': threading.Lock()}
+        # NOTE: on GPU each tower is always run by its own long-lived thread, as torch keeps the captured CUDA graphs
+        # of the compiled models per thread, any other thread would capture them again in a private memory pool
+        self._encode_executors = {'image': None, 'text': None}
+        if self._device.startswith('cuda'):
+            self._streams = {
+                'image': torch.cuda.Stream(device=self._device),
+                'text': torch.cuda.Stream(device=self._device),
+            }
+            self._encode_executors = {
+                modality: ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f'encode_{modality}'
+                )
+                for modality in ('image', 'text')
+            }
+
+        # batch the docs across the concurrent requests, waiting at most `batch_timeout_ms` for a full minibatch
+        self._batchers = None
+        if batch_timeout_ms is not None:
+            self._batchers = {
+                modality: DynamicBatcher(
+                    partial(self._encode_in_thread, modality),
+                    batch_size=minibatch_size,
+                    timeout=batch_timeout_ms / 1000,
+                    executor=self._encode_executors[modality],
+                )
+                for modality in ('image', 'text')
+            }
+
+        self._pad_batches = False
+        # NOTE: `reduce-overhead` lets TorchDynamo/Inductor fuse the ops and replay a captured CUDA graph
+        # for the fixed minibatch shape. TorchScript modules (i.e. `jit=True`) can not be compiled again.
+        if self._device.startswith('cuda') and not jit and hasattr(torch, 'compile'):
+            self._model.encode_image = torch.compile(
+                self._model.encode_image, mode='reduce-overhead'
+            )
+            self._model.encode_text = torch.compile(
+                self._model.encode_text, mode='reduce-overhead'
+            )
+            # the short last minibatch and the texts are padded to the full size, otherwise every new shape
+            # would be compiled and captured again while serving
+            self._pad_batches = True
+            self._pad_to_longest = False
+
+        self._warmup()
+
+    def _warmup(self):
+        # run one dummy minibatch through both towers, so the kernel selection and compilation costs are paid
+        # before serving rather than by the first request
+        for modality in ('image', 'text'):
+            if self._encode_executors[modality]:
+                # on the thread serving the tower, which owns its captured CUDA graphs
+                self._encode_executors[modality].submit(
+                    self._warmup_tower, modality
+                ).result()
+            else:
+                self._warmup_tower(modality)
+
+    def _warmup_tower(self, modality: str):
+        with torch.inference_mode(), self._stream(modality):
+            if modality == 'image':
+                pixel_values = torch.zeros(
+                    (
+                        self._minibatch_size,
+                        3,
+                        self._model.image_size,
+                        self._model.image_size,
+                    ),
+                    device=self._device,
+                )
+                self._model.encode_image(pixel_values=pixel_values)
+            else:
+                text_inputs = self._tokenizer([''] * self._minibatch_size)
+                self._model.encode_text(
+                    **{k: v.to(self._device) for k, v in text_inputs.items()}
+                )
+
+    def _to_numpy(self, embeddings: 'torch.Tensor', modality: str) -> 'np.ndarray':
+        if not self._device.startswith('cuda'):
+            return tensor_to_numpy(embeddings)
+
+        batch_size, embedding_dim = embeddings.shape
+        buffer = self._host_buffers.get(modality)
+        if buffer is None or buffer.shape[1] != embedding_dim:
+            buffer = torch.empty(
+                (self._minibatch_size, embedding_dim),
+                dtype=torch.float32,
+                pin_memory=True,
+            )
+            self._host_buffers[modality] = buffer
+
+        # one async D2H copy into pinned memory, which also casts the fp16 embeddings to fp32
+        buffer[:batch_size].copy_(embeddings, non_blocking=True)
+        torch.cuda.current_stream(embeddings.device).synchronize()
+
+        # the buffer is reused by the next minibatch, hence the embeddings must own their memory
+        return buffer[:batch_size].numpy().copy()
+
+    def close(self):
+        for batcher in (self._batchers or {}).values():
+            batcher.close()
+        if self._preproc_executor is not None:
+            self._preproc_executor.shutdown()
+        for executor in self._encode_executors.values():
+            if executor is not None:
+                executor.shutdown()
+        super().close()
 
     def _preproc_images(self, docs: 'DocumentArray'):
         with self.monitor(
@@ -75,6 +203,7 @@ class CLIPEncoder(Executor):
                 docs,
                 preprocess_fn=self._image_transform,
                 device=self._device,
+                executor=self._preproc_executor,
                 return_np=False,
             )
 
@@ -84,9 +213,74 @@ class CLIPEncoder(Executor):
             documentation='texts preprocess time in seconds',
         ):
             return preproc_text(
-                docs, tokenizer=self._tokenizer, device=self._device, return_np=False
+                docs,
+                tokenizer=self._tokenizer,
+                device=self._device,
+                return_np=False,
+                pad_to_longest=self._pad_to_longest,
             )
 
+    def _encode_images(self, docs: 'DocumentArray'):
+        with self._encode_locks['image']:
+            for minibatch, batch_data in prefetch_map_batch(
+                docs,
+                self._preproc_images,
+                batch_size=self._minibatch_size,
+                pool=self._pool,
+            ):
+                with self.monitor(
+                    name='encode_images_seconds',
+                    documentation='images encode time in seconds',
+                ):
+                    self._wait_preprocess()
+                    if self._pad_batches:
+                        batch_data = pad_batch(batch_data, self._minibatch_size)
+                    minibatch.embeddings = self._to_numpy(
+                        self._model.encode_image(**batch_data)[: len(minibatch)],
+                        'image',
+                    )
+
+    def _encode_texts(self, docs: 'DocumentArray'):
+        if self._pad_to_longest:
+            # group the texts of similar lengths into the same minibatch to reduce the padding,
+            # the embeddings are still set on the original docs
+            docs = DocumentArray(sorted(docs, key=lambda d: len(d.text)))
+        with self._encode_locks['text']:
+            for minibatch, batch_data in prefetch_map_batch(
+                docs,
+                self._preproc_texts,
+                batch_size=self._minibatch_size,
+                pool=self._pool,
+            ):
+                with self.monitor(
+                    name='encode_texts_seconds',
+                    documentation='texts encode time in seconds',
+                ):
+                    self._wait_preprocess()
+                    if self._pad_batches:
+                        batch_data = pad_batch(batch_data, self._minibatch_size)
+                    minibatch.embeddings = self._to_numpy(
+                        self._model.encode_text(**batch_data)[: len(minibatch)], 'text'
+                    )
+
+    def _wait_preprocess(self):
+        # the preprocessing workers copy the inputs to GPU on the default stream
+        if self._device.startswith('cuda'):
+            torch.cuda.current_stream().wait_stream(torch.cuda.default_stream())
+
+    def _stream(self, modality: str):
+        if self._device.startswith('cuda'):
+            return torch.cuda.stream(self._streams[modality])
+        return nullcontext()
+
+    def _encode_in_thread(self, modality: str, docs: 'DocumentArray'):
+        # NOTE: the inference mode is thread local, it must be entered in the worker thread
+        with torch.inference_mode(), self._stream(modality):
+            if modality == 'image':
+                self._encode_images(docs)
+            else:
+                self._encode_texts(docs)
+
     @requests(on='/rank')
     async def rank(self, docs: 'DocumentArray', parameters: Dict, **kwargs):
         await self.encode(docs['@r,m'])
@@ -102,46 +296,39 @@ class CLIPEncoder(Executor):
             )
             access_paths = parameters['traversal_paths']
 
-        _img_da = DocumentArray()
-        _txt_da = DocumentArray()
-        for d in docs[access_paths]:
-            split_img_txt_da(d, _img_da, _txt_da)
-
-        with torch.inference_mode():
-            # for image
-            if _img_da:
-                for minibatch, batch_data in _img_da.map_batch(
-                    self._preproc_images,
-                    batch_size=self._minibatch_size,
-                    pool=self._pool,
-                ):
-                    with self.monitor(
-                        name='encode_images_seconds',
-                        documentation='images encode time in seconds',
-                    ):
-                        minibatch.embeddings = (
-                            self._model.encode_image(**batch_data)
-                            .cpu()
-                            .numpy()
-                            .astype(np.float32)
-                        )
-
-            # for text
-            if _txt_da:
-                for minibatch, batch_data in _txt_da.map_batch(
-                    self._preproc_texts,
-                    batch_size=self._minibatch_size,
-                    pool=self._pool,
-                ):
-                    with self.monitor(
-                        name='encode_texts_seconds',
-                        documentation='texts encode time in seconds',
-                    ):
-                        minibatch.embeddings = (
-                            self._model.encode_text(**batch_data)
-                            .cpu()
-                            .numpy()
-                            .astype(np.float32)
-                        )
+        _img_da, _txt_da = split_img_txt_docs(docs[access_paths])
+
+        if self._batchers:
+            await asyncio.gather(
+                *(
+                    self._batchers[modality].encode(da)
+                    for modality, da in (('image', _img_da), ('text', _txt_da))
+                    if da
+                )
+            )
+        elif self._device.startswith('cuda'):
+            # the image and text towers share no state, hence they are encoded concurrently on separate CUDA streams
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        self._encode_executors[modality],
+                        self._encode_in_thread,
+                        modality,
+                        da,
+                    )
+                    for modality, da in (('image', _img_da), ('text', _txt_da))
+                    if da
+                )
+            )
+        else:
+            with torch.inference_mode():
+                # for image
+                if _img_da:
+                    self._encode_images(_img_da)
+
+                # for text
+                if _txt_da:
+                    self._encode_texts(_txt_da)
 
         return docs
@@ -1,10 +1,18 @@
-from typing import Tuple, List, Callable, Any, Dict
+import asyncio
+import multiprocessing
+import warnings
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from multiprocessing.pool import ThreadPool
+from typing import Tuple, List, Callable, Any, Dict, Optional, Generator
 import torch
 import numpy as np
 from docarray import Document, DocumentArray
 from docarray.math.distance.numpy import cosine
 
 
+from clip_server.model.clip import _MEAN, _STD, _transform_ndarray_crop
 from clip_server.model.tokenization import Tokenizer
 
 
@@ -16,47 +24,134 @@ def numpy_softmax(x: 'np.ndarray', axis: int = -1) -> 'np.ndarray':
     return f_x
 
 
+# the image transform of a preprocessing worker process, set by `_init_preproc_worker`
+_worker_image_transform = None
+
+
+def _init_preproc_worker(image_size: int):
+    global _worker_image_transform
+    _worker_image_transform = _transform_ndarray_crop(image_size)
+
+
+def _preproc_image_worker(content: Tuple) -> 'np.ndarray':
+    blob, uri, tensor = content
+    if blob:
+        tensor = Document(blob=blob).convert_blob_to_image_tensor().tensor
+    elif tensor is None and uri:
+        tensor = Document(uri=uri).load_uri_to_image_tensor().tensor
+
+    return _worker_image_transform(tensor).numpy()
+
+
+def create_preproc_executor(
+    backend: str, num_workers: int, image_size: int
+) -> Optional['ProcessPoolExecutor']:
+    """Create the process pool to decode and crop images out of the GIL, `None` for the `thread` backend."""
+    if backend == 'thread':
+        return None
+    elif backend != 'process':
+        raise ValueError(
+            f'preprocess backend `{backend}` is not supported, use `thread` or `process`.'
+        )
+
+    if multiprocessing.current_process().daemon:
+        warnings.warn(
+            'daemonic processes are not allowed to have children, fallback to the `thread` preprocess backend.'
+        )
+        return None
+
+    # NOTE: `spawn` instead of `fork`, forking after CUDA/OpenMP have been initialized is unsafe
+    return ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_preproc_worker,
+        initargs=(image_size,),
+    )
+
+
 def preproc_image(
     da: 'DocumentArray',
     preprocess_fn: Callable,
     device: str = 'cpu',
     return_np: bool = False,
+    executor: Optional['ProcessPoolExecutor'] = None,
 ) -> Tuple['DocumentArray', Dict]:
 
-    tensors_batch = []
+    if executor is not None:
+        # only the raw contents are sent to the workers, the docs themselves are left untouched
+        tensors_batch = [
+            torch.from_numpy(t)
+            for t in executor.map(
+                _preproc_image_worker, [(d.blob, d.uri, d.tensor) for d in da]
+            )
+        ]
+    else:
+        tensors_batch = []
 
-    for d in da:
-        content = d.content
+        for d in da:
+            content = d.content
 
-        if d.blob:
-            d.convert_blob_to_image_tensor()
-        elif d.tensor is None and d.uri:
-            # in case user uses HTTP protocol and send data via curl not using .blob (base64), but in .uri
-            d.load_uri_to_image_tensor()
+            if d.blob:
+                d.convert_blob_to_image_tensor()
+            elif d.tensor is None and d.uri:
+                # in case user uses HTTP protocol and send data via curl not using .blob (base64), but in .uri
+                d.load_uri_to_image_tensor()
 
-        tensors_batch.append(preprocess_fn(d.tensor).detach())
+            tensors_batch.append(preprocess_fn(d.tensor).detach())
 
-        # recover doc content
-        d.content = content
+            # recover doc content
+            d.content = content
 
-    tensors_batch = torch.stack(tensors_batch).type(torch.float32)
+    if return_np:
+        device = 'cpu'
+    tensors_batch = normalize_image_batch(tensors_batch, device=device)
 
     if return_np:
-        tensors_batch = tensors_batch.cpu().numpy()
-    else:
-        tensors_batch = tensors_batch.to(device)
+        tensors_batch = tensors_batch.numpy()
 
     return da, {'pixel_values': tensors_batch}
 
 
+@lru_cache()
+def _image_mean_std(device: str) -> Tuple['torch.Tensor', 'torch.Tensor']:
+    mean = torch.tensor(_MEAN, dtype=torch.float32, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(_STD, dtype=torch.float32, device=device).view(1, 3, 1, 1)
+    return mean, std
+
+
+def normalize_image_batch(
+    tensors: List['torch.Tensor'], device: str = 'cpu'
+) -> 'torch.Tensor':
+    """Normalize the cropped images in one pass over the whole batch on the target device.
+
+    :param tensors: the CHW float image crops scaled to [0, 1]
+    :param device: the device to normalize the batch on
+    :return: the normalized float32 batch of shape [batch size, 3, H, W] on `device`
+    """
+    # the crops are written straight into the (pinned) batch, page-locked blocks are recycled by torch's host allocator
+    batch = torch.empty(
+        (len(tensors), *tensors[0].shape),
+        dtype=torch.float32,
+        pin_memory=device.startswith('cuda'),
+    )
+    for i, t in enumerate(tensors):
+        batch[i] = t
+
+    batch = batch.to(device, non_blocking=True)
+
+    mean, std = _image_mean_std(device)
+    return batch.sub_(mean).div_(std)
+
+
 def preproc_text(
     da: 'DocumentArray',
     tokenizer: 'Tokenizer',
     device: str = 'cpu',
     return_np: bool = False,
+    pad_to_longest: bool = False,
 ) -> Tuple['DocumentArray', Dict]:
 
-    inputs = tokenizer(da.texts)
+    inputs = tokenizer(da.texts, pad_to_longest=pad_to_longest)
     inputs['input_ids'] = inputs['input_ids'].detach()
 
     if return_np:
@@ -64,6 +159,10 @@ def preproc_text(
         inputs['attention_mask'] = (
             inputs['attention_mask'].cpu().numpy().astype(np.int32)
         )
+    elif device.startswith('cuda'):
+        # the copies from page-locked memory run asynchronously to the host
+        for k in ('input_ids', 'attention_mask'):
+            inputs[k] = inputs[k].pin_memory().to(device, non_blocking=True)
     else:
         inputs['input_ids'] = inputs['input_ids'].to(device)
         inputs['attention_mask'] = inputs['attention_mask'].to(device)
@@ -72,6 +171,155 @@ def preproc_text(
     return da, inputs
 
 
+def prefetch_map_batch(
+    da: 'DocumentArray',
+    func: Callable,
+    batch_size: int,
+    pool: 'ThreadPool',
+    prefetch: int = 4,
+) -> Generator:
+    """Like `DocumentArray.map_batch`, but at most `prefetch` minibatches are preprocessed ahead of the consumer.
+
+    The minibatches are yielded in order, while the next ones are preprocessed in the pool during the encoding.
+    """
+    pending = deque()
+    for batch in da.batch(batch_size=batch_size):
+        pending.append(pool.apply_async(func, (batch,)))
+        if len(pending) >= prefetch:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+class DynamicBatcher:
+    """Gather the docs of concurrent small requests into shared minibatches.
+
+    The docs are queued with a future each, a background task takes up to `batch_size` docs, waiting at most
+    `timeout` seconds for more to arrive, and encodes them in one call of `encode_fn` in a worker thread.
+    Requests with a full minibatch or more are encoded right away. `encode_fn` is run by `executor`, the default
+    executor of the event loop if not given. If a shared minibatch fails, the docs of each
+    request are encoded again on their own, so that only the request causing the error fails.
+    """
+
+    def __init__(
+        self,
+        encode_fn: Callable[['DocumentArray'], Any],
+        batch_size: int,
+        timeout: float,
+        executor: Optional['Executor'] = None,
+    ):
+        self._encode_fn = encode_fn
+        self._executor = executor
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self._queue = None
+        self._worker = None
+        # the items taken off the queue by the background task and not encoded yet
+        self._batch = []
+
+    async def encode(self, docs: 'DocumentArray'):
+        loop = asyncio.get_running_loop()
+        if len(docs) >= self._batch_size:
+            await loop.run_in_executor(self._executor, self._encode_fn, docs)
+            return
+
+        # created lazily, to be bound to the event loop serving the requests
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.ensure_future(self._run())
+
+        # the request is identified by its DocumentArray, to isolate the failures of a shared minibatch
+        futures = []
+        for d in docs:
+            future = loop.create_future()
+            self._queue.put_nowait((d, future, id(docs)))
+            futures.append(future)
+        await asyncio.gather(*futures)
+
+    async def _next_batch(self) -> List[Tuple['Document', 'asyncio.Future', int]]:
+        loop = asyncio.get_running_loop()
+        self._batch = items = [await self._queue.get()]
+        deadline = loop.time() + self._timeout
+        while len(items) < self._batch_size:
+            if not self._queue.empty():
+                items.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    def close(self):
+        """Stop the background task, the docs still queued or being encoded fail with a `RuntimeError`.
+
+        It must be called from the thread running the event loop.
+        """
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        while not self._queue.empty():
+            self._batch.append(self._queue.get_nowait())
+        for _, future, _ in self._batch:
+            if not future.done():
+                future.set_exception(RuntimeError('the batcher is closed'))
+
+    async def _encode_items(
+        self, items: List[Tuple['Document', 'asyncio.Future', int]]
+    ):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self._executor,
+                self._encode_fn,
+                DocumentArray([d for d, _, _ in items]),
+            )
+        except Exception as ex:
+            requests = {}
+            for item in items:
+                requests.setdefault(item[2], []).append(item)
+
+            if len(requests) > 1:
+                for request_items in requests.values():
+                    await self._encode_items(request_items)
+                return
+
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_exception(ex)
+        else:
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_result(None)
+
+    async def _run(self):
+        while True:
+            await self._encode_items(await self._next_batch())
+
+
+def pad_batch(batch_data: Dict, batch_size: int) -> Dict:
+    """Right-pad the inputs of a short minibatch with zeros to `batch_size` rows, to keep the shapes static."""
+    padded = {}
+    for k, v in batch_data.items():
+        num_pads = batch_size - len(v)
+        if num_pads <= 0:
+            padded[k] = v
+        elif isinstance(v, np.ndarray):
+            padded[k] = np.pad(v, [(0, num_pads)] + [(0, 0)] * (v.ndim - 1))
+        else:
+            padded[k] = torch.cat([v, v.new_zeros((num_pads, *v.shape[1:]))])
+    return padded
+
+
+def tensor_to_numpy(tensor: 'torch.Tensor') -> 'np.ndarray':
+    """Copy the embeddings to a float32 numpy array, the cast is skipped if they are float32 already."""
+    return tensor.detach().cpu().numpy().astype(np.float32, copy=False)
+
+
 def split_img_txt_da(doc: 'Document', img_da: 'DocumentArray', txt_da: 'DocumentArray'):
     if doc.text:
         txt_da.append(doc)
@@ -79,6 +327,31 @@ def split_img_txt_da(doc: 'Document', img_da: 'DocumentArray', txt_da: 'Document
         img_da.append(doc)
 
 
+def split_img_txt_docs(
+    da: 'DocumentArray',
+) -> Tuple['DocumentArray', 'DocumentArray']:
+    """Partition the docs into an image and a text DocumentArray in one pass, the docs are shared, not copied.
+
+    The docs with neither a text nor an image are dropped, in the same way as in :func:`split_img_txt_da`.
+    """
+    # 0 for the docs to drop, 1 for images and 2 for texts
+    modalities = np.fromiter(
+        (
+            2 if d.text else 1 if d.blob or (d.tensor is not None) or d.uri else 0
+            for d in da
+        ),
+        dtype=np.int8,
+        count=len(da),
+    )
+    img_idx = np.flatnonzero(modalities == 1).tolist()
+    txt_idx = np.flatnonzero(modalities == 2).tolist()
+    # NOTE: a DocumentArray can not be indexed by an empty list
+    return (
+        da[img_idx] if img_idx else DocumentArray(),
+        da[txt_idx] if txt_idx else DocumentArray(),
+    )
+
+
 def set_rank(docs, _logit_scale=np.exp(4.60517)):
     queries = docs
     candidates = docs['@m']
@@ -2,6 +2,8 @@
 
 import io
 
+import numpy as np
+import torch
 from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 
@@ -12,6 +14,9 @@ try:
 except ImportError:
     BICUBIC = Image.BICUBIC
 
+_MEAN = (0.48145466, 0.4578275, 0.40821073)
+_STD = (0.26862954, 0.26130258, 0.27577711)
+
 
 def _convert_image_to_rgb(image):
     return image.convert('RGB')
@@ -29,10 +34,7 @@ def _transform_blob(n_px):
             CenterCrop(n_px),
             _convert_image_to_rgb,
             ToTensor(),
-            Normalize(
-                (0.48145466, 0.4578275, 0.40821073),
-                (0.26862954, 0.26130258, 0.27577711),
-            ),
+            Normalize(_MEAN, _STD),
         ]
     )
 
@@ -43,9 +45,28 @@ def _transform_ndarray(n_px):
             ToTensor(),
             Resize(n_px, interpolation=BICUBIC),
             CenterCrop(n_px),
-            Normalize(
-                (0.48145466, 0.4578275, 0.40821073),
-                (0.26862954, 0.26130258, 0.27577711),
-            ),
+            Normalize(_MEAN, _STD),
+        ]
+    )
+
+
+def _ndarray_to_tensor(image):
+    # HWC -> CHW, the uint8 images are scaled to [0, 1] as in `ToTensor`, so that the bicubic resize neither
+    # rounds the pixel values nor clips its overshoot
+    if image.ndim == 2:
+        image = image[:, :, None]
+    tensor = torch.from_numpy(np.ascontiguousarray(image.transpose((2, 0, 1))))
+    if tensor.dtype == torch.uint8:
+        tensor = tensor.float().div_(255)
+    return tensor
+
+
+def _transform_ndarray_crop(n_px):
+    """The resize and center crop steps of `_transform_ndarray`, the normalization is left to the batch"""
+    return Compose(
+        [
+            _ndarray_to_tensor,
+            Resize(n_px, interpolation=BICUBIC),
+            CenterCrop(n_px),
         ]
     )
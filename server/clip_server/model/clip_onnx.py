@@ -1,5 +1,10 @@
+import hashlib
 import os
-from typing import Dict
+import threading
+import warnings
+from typing import Dict, List, Optional
+
+import numpy as np
 
 from clip_server.model.pretrained_models import (
     download_model,
@@ -153,6 +158,64 @@ _MODELS = {
     # ),
 }
 
+_ORT_TENSOR_DTYPES = {
+    'tensor(float)': 'float32',
+    'tensor(float16)': 'float16',
+}
+
+
+def _split_provider(provider):
+    if isinstance(provider, (tuple, list)):
+        return provider
+    return provider, None
+
+
+def _cuda_graph_enabled(providers_or_session) -> bool:
+    if isinstance(providers_or_session, (tuple, list)):
+        provider_options = dict(map(_split_provider, providers_or_session))
+    else:
+        provider_options = providers_or_session.get_provider_options()
+    options = provider_options.get('CUDAExecutionProvider') or {}
+    return str(options.get('enable_cuda_graph', '0')) in ('1', 'True', 'true')
+
+
+def _quantize_model(model_path: str) -> str:
+    """Quantize the weights of an ONNX model to int8, the result is cached under `~/.cache/clip/int8`."""
+    # NOTE: the user given model folder may be read-only, the cache is keyed by the path and version of the model
+    stat = os.stat(model_path)
+    key = hashlib.md5(
+        f'{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode()
+    ).hexdigest()
+    cache_dir = os.path.expanduser(f'~/.cache/clip/int8/{key}')
+    quantized_path = os.path.join(
+        cache_dir, f'{os.path.splitext(os.path.basename(model_path))[0]}-int8.onnx'
+    )
+    if not os.path.isfile(quantized_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        # write to a temporary file first, as the replicas may quantize the same model concurrently
+        tmp_path = f'{quantized_path}.{os.getpid()}.part'
+        quantize_dynamic(
+            model_input=model_path,
+            model_output=tmp_path,
+            weight_type=QuantType.QInt8,
+        )
+        os.replace(tmp_path, quantized_path)
+    return quantized_path
+
+
+def _bind_tensor(bind_fn, name: str, tensor):
+    """Bind a contiguous torch tensor living on device to an IOBinding via its data pointer"""
+    bind_fn(
+        name=name,
+        device_type=tensor.device.type,
+        device_id=tensor.device.index or 0,
+        element_type=np.dtype(str(tensor.dtype).replace('torch.', '')),
+        shape=tuple(tensor.shape),
+        buffer_ptr=tensor.data_ptr(),
+    )
+
 
 class CLIPOnnxModel(BaseCLIPModel):
     def __init__(self, name: str, model_path: str = None):
@@ -209,22 +272,149 @@ class CLIPOnnxModel(BaseCLIPModel):
 
         return name
 
+    def quantize(self):
+        """Switch to the int8 quantized models, which speeds up the inference on CPU."""
+        self._textual_path = _quantize_model(self._textual_path)
+        self._visual_path = _quantize_model(self._visual_path)
+
     def start_sessions(
         self,
+        minibatch_size: Optional[int] = None,
         **kwargs,
     ):
+        self._visual_session = self._create_session(self._visual_path, **kwargs)
+        self._textual_session = self._create_session(self._textual_path, **kwargs)
+
+        # bind the inputs/outputs on device to avoid the implicit host <-> device copies in `session.run`
+        self._use_io_binding = (
+            'CUDAExecutionProvider' in self._visual_session.get_providers()
+        )
+        if self._use_io_binding:
+            cuda_options = self._visual_session.get_provider_options()[
+                'CUDAExecutionProvider'
+            ]
+            self._device_id = int(cuda_options['device_id'])
+
+        self._minibatch_size = minibatch_size
+        self._cuda_graph_sessions = [
+            session
+            for session in (self._visual_session, self._textual_session)
+            if minibatch_size and _cuda_graph_enabled(session)
+        ]
+        self._static_io_bindings = {}
+        # the persistent buffers of a CUDA graph session can only serve one run at a time
+        self._cuda_graph_locks = {
+            session: threading.Lock() for session in self._cuda_graph_sessions
+        }
+
+    @property
+    def use_io_binding(self) -> bool:
+        """Whether the sessions run on the CUDA Execution Provider, i.e. take the inputs on GPU."""
+        return self._use_io_binding
+
+    @property
+    def image_session(self):
+        return self._visual_session
+
+    @property
+    def text_session(self):
+        return self._textual_session
+
+    @staticmethod
+    def _create_session(model_path: str, providers: List = (), **kwargs):
         import onnxruntime as ort
 
-        self._visual_session = ort.InferenceSession(self._visual_path, **kwargs)
-        self._visual_session.disable_fallback()
+        try:
+            session = ort.InferenceSession(model_path, providers=providers, **kwargs)
+        except Exception as ex:
+            if not _cuda_graph_enabled(providers):
+                raise
+            # CUDA graph requires all the nodes to be placed on the CUDA Execution Provider
+            warnings.warn(
+                f'Failed to enable CUDA graph for {model_path} ({ex!r}), fallback to the plain CUDA execution.'
+            )
+            providers = [
+                (name, {k: v for k, v in options.items() if k != 'enable_cuda_graph'})
+                if isinstance(options, dict)
+                else name
+                for name, options in map(_split_provider, providers)
+            ]
+            session = ort.InferenceSession(model_path, providers=providers, **kwargs)
+
+        session.disable_fallback()
+        return session
+
+    def _run_cuda_graph(self, session, inputs: Dict):
+        import torch
+
+        # the captured CUDA graph is replayed on the same device addresses, hence the inputs and outputs are bound
+        # once to persistent buffers of `minibatch_size` and every minibatch is copied into them.
+        if session not in self._static_io_bindings:
+            device = torch.device('cuda', self._device_id)
+            io_binding = session.io_binding()
+            buffers = {}
+            for node in session.get_inputs():
+                value = torch.as_tensor(inputs[node.name])
+                buffers[node.name] = torch.zeros(
+                    (self._minibatch_size, *value.shape[1:]),
+                    dtype=value.dtype,
+                    device=device,
+                )
+                _bind_tensor(io_binding.bind_input, node.name, buffers[node.name])
+
+            (output_node,) = session.get_outputs()
+            output = torch.zeros(
+                (self._minibatch_size, output_node.shape[-1]),
+                dtype=getattr(torch, _ORT_TENSOR_DTYPES[output_node.type]),
+                device=device,
+            )
+            _bind_tensor(io_binding.bind_output, output_node.name, output)
+
+            self._static_io_bindings[session] = (io_binding, buffers, output)
+
+        io_binding, buffers, output = self._static_io_bindings[session]
+
+        # the rows beyond `batch_size` are stale paddings from the previous minibatch, their outputs are discarded
+        batch_size = None
+        for name, buffer in buffers.items():
+            value = torch.as_tensor(inputs[name])
+            batch_size = value.shape[0]
+            buffer[:batch_size].copy_(value)
+        torch.cuda.current_stream(output.device).synchronize()
+
+        session.run_with_iobinding(io_binding)
+        return output[:batch_size].cpu().numpy()
+
+    def _run(self, session, inputs: Dict):
+        if not self._use_io_binding:
+            (output,) = session.run(None, inputs)
+            return output
+
+        if session in self._cuda_graph_sessions:
+            with self._cuda_graph_locks[session]:
+                return self._run_cuda_graph(session, inputs)
+
+        import torch
+
+        io_binding = session.io_binding()
+        for node in session.get_inputs():
+            value = inputs[node.name]
+            if isinstance(value, np.ndarray):
+                io_binding.bind_cpu_input(node.name, value)
+            else:
+                # a torch tensor which already lives on the device, its preprocessing runs on the default stream
+                value = value.contiguous()
+                torch.cuda.default_stream(value.device).synchronize()
+                _bind_tensor(io_binding.bind_input, node.name, value)
+        for node in session.get_outputs():
+            io_binding.bind_output(node.name, 'cuda', self._device_id)
 
-        self._textual_session = ort.InferenceSession(self._textual_path, **kwargs)
-        self._textual_session.disable_fallback()
+        session.run_with_iobinding(io_binding)
+        (output,) = io_binding.copy_outputs_to_cpu()
+        return output
 
     def encode_image(self, image_input: Dict):
-        (visual_output,) = self._visual_session.run(None, image_input)
-        return visual_output
+        return self._run(self._visual_session, image_input)
 
     def encode_text(self, text_input: Dict):
-        (textual_output,) = self._textual_session.run(None, text_input)
-        return textual_output
+        return self._run(self._textual_session, text_input)
@@ -5,6 +5,7 @@ import torch
 import open_clip
 
 from clip_server.model.clip_model import CLIPModel
+from clip_server.model.model import optimize_jit_model
 
 _CLIP_MODEL_MAPS = {
     'M-CLIP/XLM-Roberta-Large-Vit-B-32': ('ViT-B-32', 'openai'),
@@ -62,6 +63,15 @@ class MultilingualCLIPModel(CLIPModel):
             clip_name, pretrained=clip_pretrained, device=device, jit=jit
         )
         self._model.eval()
+        if jit:
+            self._model = optimize_jit_model(self._model)
+
+        # NOTE: run in fp16 on GPU, in the same way as the OpenCLIP models
+        self._dtype = torch.float32
+        if str(device).startswith('cuda') and not jit:
+            self._dtype = torch.float16
+            self._mclip_model.half()
+            self._model.half()
 
         self._clip_name = clip_name
 
@@ -76,5 +86,5 @@ class MultilingualCLIPModel(CLIPModel):
             input_ids=input_ids, attention_mask=attention_mask, **kwargs
         )
 
-    def encode_image(self, pixel_values: torch.Tensor):
-        return self._model.encode_image(pixel_values)
+    def encode_image(self, pixel_values: torch.Tensor, **kwargs):
+        return self._model.encode_image(pixel_values.type(self._dtype))
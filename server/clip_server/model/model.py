@@ -570,9 +570,11 @@ class CLIP(nn.Module):
     def encode_text(self, text):
         x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
 
-        x = x + self.positional_embedding.type(self.dtype)
+        # the texts may be padded shorter than the context length, which is exact under the causal attention mask
+        seq_len = text.shape[1]
+        x = x + self.positional_embedding[:seq_len].type(self.dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x, attn_mask=self.attn_mask)
+        x = self.transformer(x, attn_mask=self.attn_mask[:seq_len, :seq_len])
         x = x.permute(1, 0, 2)  # LND -> NLD
         x = self.ln_final(x).type(self.dtype)
 
@@ -718,6 +720,21 @@ def build_model_from_openai_state_dict(state_dict: dict):
     return model.eval()
 
 
+def optimize_jit_model(model):
+    """Freeze a scripted CLIP model and apply the inference-only optimizations.
+
+    The weights are folded into constants and the ops are fused, both `encode_image` and `encode_text` are
+    preserved. The model is returned unchanged (with a warning) if it can not be frozen.
+    """
+    methods = ['encode_image', 'encode_text']
+    try:
+        model = torch.jit.freeze(model.eval(), preserved_attrs=methods)
+        model = torch.jit.optimize_for_inference(model, other_methods=methods)
+    except Exception as ex:
+        warnings.warn(f'Failed to freeze the JIT model, run it unfrozen instead: {ex}')
+    return model
+
+
 def load_openai_model(
     model_path: str,
     device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu",
@@ -7,7 +7,11 @@
 
 from clip_server.model.clip_model import CLIPModel
 from clip_server.model.pretrained_models import get_model_url_md5, download_model
-from clip_server.model.model import load_openai_model, load_openclip_model
+from clip_server.model.model import (
+    load_openai_model,
+    load_openclip_model,
+    optimize_jit_model,
+)
 
 import torch
 
@@ -34,6 +38,9 @@ class OpenCLIPModel(CLIPModel):
                 self._model_name, model_path=model_path, device=device, jit=jit
             )
 
+        if jit:
+            self._model = optimize_jit_model(self._model)
+
     @staticmethod
     def get_model_name(name: str):
         if '::' in name:
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 from typing import List, Union
 from clip_server.model.pretrained_models import _MULTILINGUALCLIP_MODELS
@@ -20,22 +21,31 @@ class Tokenizer:
         texts: Union[str, List[str]],
         context_length: int = 77,
         truncate: bool = True,
+        pad_to_longest: bool = False,
     ):
         """
         :param texts: An input string or a list of input strings to tokenize
         :param context_length: The context length to use; all CLIP models use 77 as the context length.
         :param truncate: Whether to truncate the text in case its encoding is longer than the context length.
+        :param pad_to_longest: Whether to pad to the longest text (rounded up to a multiple of 8) rather than to the
+            context length. A static shape, which the compiled models rely on, is only kept with `False`.
 
         :return: A dict of tokenized representations of the input strings and their corresponding attention masks with both
             shape = [batch size, context_length]
         """
-        return self._tokenize(texts, context_length=context_length, truncate=truncate)
+        return self._tokenize(
+            texts,
+            context_length=context_length,
+            truncate=truncate,
+            pad_to_longest=pad_to_longest,
+        )
 
     def _tokenize(
         self,
         texts: Union[str, List[str]],
         context_length: int = 77,
         truncate: bool = True,
+        pad_to_longest: bool = False,
     ) -> dict:
         if isinstance(texts, str):
             texts = [texts]
@@ -45,7 +55,7 @@ class Tokenizer:
                 max_length=context_length,
                 return_attention_mask=True,
                 return_tensors='pt',
-                padding=True,
+                padding=True if pad_to_longest else 'max_length',
                 truncation=True,
             )
             return {
@@ -60,10 +70,14 @@ class Tokenizer:
                 for text in texts
             ]
 
-            input_ids = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
-            attention_mask = torch.zeros(
-                len(all_tokens), context_length, dtype=torch.long
-            )
+            if pad_to_longest and all_tokens:
+                # round up to bound the number of distinct shapes seen by the model
+                longest = max(len(tokens) for tokens in all_tokens)
+                context_length = min(context_length, -(-longest // 8) * 8)
+
+            # fill the rows in numpy, rather than allocating a tensor per text
+            input_ids = np.zeros((len(all_tokens), context_length), dtype=np.int64)
+            attention_mask = np.zeros((len(all_tokens), context_length), dtype=np.int64)
 
             for i, tokens in enumerate(all_tokens):
                 if len(tokens) > context_length:
@@ -74,7 +88,10 @@ class Tokenizer:
                         raise RuntimeError(
                             f'Input {texts[i]} is too long for context length {context_length}'
                         )
-                input_ids[i, : len(tokens)] = torch.tensor(tokens)
+                input_ids[i, : len(tokens)] = tokens
                 attention_mask[i, : len(tokens)] = 1
 
-            return {'input_ids': input_ids, 'attention_mask': attention_mask}
+            return {
+                'input_ids': torch.from_numpy(input_ids),
+                'attention_mask': torch.from_numpy(attention_mask),
+            }
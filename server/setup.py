@@ -56,7 +56,7 @@ setup(
             'onnxruntime',
             'onnx',
         ]
-        + (['onnxruntime-gpu>=1.8.0'] if sys.platform != 'darwin' else []),
+        + (['onnxruntime-gpu>=1.12.0'] if sys.platform != 'darwin' else []),
         'tensorrt': ['nvidia-tensorrt'],
         'transformers': ['transformers>=4.16.2'],
     },
@@ -1,7 +1,17 @@
+import asyncio
+import os
+
 import pytest
 import numpy as np
+import torch
 from clip_server.executors.helper import numpy_softmax
 from clip_server.executors.helper import split_img_txt_da
+from clip_server.executors.helper import split_img_txt_docs
+from clip_server.executors.helper import create_preproc_executor
+from clip_server.executors.helper import prefetch_map_batch
+from clip_server.executors.helper import tensor_to_numpy
+from clip_server.executors.helper import DynamicBatcher
+from clip_server.executors.helper import pad_batch
 from docarray import Document, DocumentArray
 
 
@@ -77,3 +87,177 @@ def test_split_img_txt_da(inputs):
         split_img_txt_da(doc, img_da, txt_da)
     assert len(txt_da) == inputs[1][0]
     assert len(img_da) == inputs[1][1]
+
+
+def test_split_img_txt_docs():
+    da = DocumentArray(
+        [
+            Document(text='hello, world'),
+            Document(uri='https://docarray.jina.ai/_static/favicon.png'),
+            Document(),
+            Document(tensor=np.array([0, 1, 2])),
+            Document(text='hello', uri='https://docarray.jina.ai/_static/favicon.png'),
+        ]
+    )
+    img_da, txt_da = split_img_txt_docs(da)
+    assert [d.id for d in img_da] == [da[1].id, da[3].id]
+    assert [d.id for d in txt_da] == [da[0].id, da[4].id]
+    assert img_da[0] is da[1]
+
+    img_da, txt_da = split_img_txt_docs(DocumentArray([Document(text='hello')]))
+    assert len(img_da) == 0 and len(txt_da) == 1
+
+
+def test_create_preproc_executor():
+    assert create_preproc_executor('thread', 4, 224) is None
+
+    executor = create_preproc_executor('process', 2, 224)
+    assert executor is not None
+    executor.shutdown()
+
+    with pytest.raises(ValueError):
+        create_preproc_executor('gpu', 4, 224)
+
+
+def test_preproc_image_process_backend():
+    from clip_server.executors.helper import preproc_image
+    from clip_server.model.clip import _transform_ndarray_crop
+
+    uri = os.path.join(os.path.dirname(__file__), 'img', '00000.jpg')
+
+    def _docs():
+        return DocumentArray(
+            [
+                Document(uri=uri),
+                Document(uri=uri).load_uri_to_blob(),
+                Document(
+                    tensor=np.random.RandomState(0).randint(
+                        0, 256, [60, 80, 3], dtype=np.uint8
+                    )
+                ),
+            ]
+        )
+
+    executor = create_preproc_executor('process', 2, 224)
+    try:
+        da = _docs()
+        contents = [d.content for d in da]
+        _, batch = preproc_image(
+            da, _transform_ndarray_crop(224), return_np=True, executor=executor
+        )
+    finally:
+        executor.shutdown()
+
+    _, expected = preproc_image(_docs(), _transform_ndarray_crop(224), return_np=True)
+    np.testing.assert_allclose(
+        batch['pixel_values'], expected['pixel_values'], atol=1e-6
+    )
+    # the docs are left untouched
+    for d, content in zip(da, contents):
+        assert d.content is content
+
+
+@pytest.mark.parametrize('num_docs, batch_size', [(10, 3), (3, 5), (8, 2)])
+@pytest.mark.parametrize('prefetch', [1, 4])
+def test_prefetch_map_batch(num_docs, batch_size, prefetch):
+    from multiprocessing.pool import ThreadPool
+
+    da = DocumentArray([Document(text=f'{i}') for i in range(num_docs)])
+
+    def _func(docs):
+        return docs, len(docs)
+
+    texts = []
+    for minibatch, size in prefetch_map_batch(
+        da, _func, batch_size=batch_size, pool=ThreadPool(2), prefetch=prefetch
+    ):
+        assert len(minibatch) == size <= batch_size
+        texts.extend(minibatch.texts)
+    assert texts == da.texts
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16', 'float64'])
+def test_tensor_to_numpy(dtype):
+    import torch
+
+    tensor = torch.rand((4, 8), dtype=getattr(torch, dtype))
+    embeddings = tensor_to_numpy(tensor)
+    assert embeddings.dtype == np.float32
+    np.testing.assert_allclose(embeddings, tensor.float().numpy())
+
+
+@pytest.mark.parametrize('to_torch', [False, True])
+def test_pad_batch(to_torch):
+    batch_data = {
+        'pixel_values': np.ones((3, 3, 4, 4), dtype=np.float32),
+        'input_ids': np.ones((3, 8), dtype=np.int32),
+    }
+    if to_torch:
+        batch_data = {k: torch.from_numpy(v) for k, v in batch_data.items()}
+
+    padded = pad_batch(batch_data, 5)
+    for k, v in padded.items():
+        assert type(v) is type(batch_data[k])
+        assert tuple(v.shape) == (5, *batch_data[k].shape[1:])
+        assert v.dtype == batch_data[k].dtype
+        assert (np.asarray(v[:3]) == 1).all()
+        assert (np.asarray(v[3:]) == 0).all()
+
+    assert pad_batch(batch_data, 3)['input_ids'] is batch_data['input_ids']
+
+
+@pytest.mark.asyncio
+async def test_dynamic_batcher():
+    batches = []
+
+    def encode_fn(da):
+        batches.append(len(da))
+        for d in da:
+            d.embedding = np.array([len(d.text)], dtype=np.float32)
+
+    batcher = DynamicBatcher(encode_fn, batch_size=8, timeout=0.05)
+    requests = [
+        DocumentArray([Document(text='x' * (i + j)) for j in range(3)])
+        for i in range(4)
+    ]
+    await asyncio.gather(*(batcher.encode(da) for da in requests))
+
+    assert sum(batches) == 12
+    assert max(batches) == 8
+    for i, da in enumerate(requests):
+        assert [d.embedding[0] for d in da] == [i + j for j in range(3)]
+
+
+@pytest.mark.asyncio
+async def test_dynamic_batcher_isolates_failures():
+    def encode_fn(da):
+        if 'boom' in da.texts:
+            raise ValueError('boom')
+        for d in da:
+            d.embedding = np.array([len(d.text)], dtype=np.float32)
+
+    batcher = DynamicBatcher(encode_fn, batch_size=8, timeout=0.05)
+    good = DocumentArray([Document(text='hello'), Document(text='world!')])
+    bad = DocumentArray([Document(text='boom')])
+    results = await asyncio.gather(
+        batcher.encode(good), batcher.encode(bad), return_exceptions=True
+    )
+
+    assert results[0] is None
+    assert isinstance(results[1], ValueError)
+    assert [d.embedding[0] for d in good] == [5, 6]
+
+
+@pytest.mark.asyncio
+async def test_dynamic_batcher_close():
+    batcher = DynamicBatcher(lambda da: None, batch_size=8, timeout=10)
+    task = asyncio.ensure_future(
+        batcher.encode(DocumentArray([Document(text='hello')]))
+    )
+    await asyncio.sleep(0.01)
+    batcher.close()
+
+    with pytest.raises(RuntimeError):
+        await task
+    await asyncio.sleep(0)
+    assert batcher._worker.cancelled()
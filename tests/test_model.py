@@ -1,7 +1,10 @@
 import pytest
+import numpy as np
+import torch
 from clip_server.model.clip_model import CLIPModel
 from clip_server.model.openclip_model import OpenCLIPModel
 from clip_server.model.mclip_model import MultilingualCLIPModel
+from clip_server.model.model import CLIP, optimize_jit_model
 
 
 @pytest.mark.parametrize(
@@ -15,3 +18,108 @@ from clip_server.model.mclip_model import MultilingualCLIPModel
 def test_model_name(name, model_cls):
     model = CLIPModel(name)
     assert model.__class__ == model_cls
+
+
+def test_optimize_jit_model():
+    model = CLIP(
+        embed_dim=64,
+        vision_cfg=dict(layers=2, width=64, patch_size=16, image_size=64),
+        text_cfg=dict(context_length=77, vocab_size=1000, width=64, heads=2, layers=2),
+    ).eval()
+    frozen = optimize_jit_model(torch.jit.script(model))
+
+    pixel_values = torch.randn(2, 3, 64, 64)
+    input_ids = torch.randint(0, 1000, (2, 77))
+    with torch.inference_mode():
+        assert torch.allclose(
+            frozen.encode_image(pixel_values), model.encode_image(pixel_values)
+        )
+        assert torch.allclose(
+            frozen.encode_text(input_ids), model.encode_text(input_ids)
+        )
+
+
+def test_encode_text_pad_to_longest():
+    from clip_server.model.tokenization import Tokenizer
+
+    model = CLIP(
+        embed_dim=64,
+        vision_cfg=dict(layers=2, width=64, patch_size=16, image_size=64),
+        text_cfg=dict(context_length=77, vocab_size=49408, width=64, heads=2, layers=2),
+    ).eval()
+    tokenizer = Tokenizer('ViT-B-32::openai')
+    texts = ['hello world', 'a photo of a cat sitting on a mat']
+
+    full = tokenizer(texts)
+    padded = tokenizer(texts, pad_to_longest=True)
+    assert padded['input_ids'].shape[1] < full['input_ids'].shape[1]
+    with torch.inference_mode():
+        assert torch.allclose(
+            model.encode_text(padded['input_ids']),
+            model.encode_text(full['input_ids']),
+            atol=1e-6,
+        )
+
+
+def _save_linear_onnx(path, input_name, input_shape, input_type, weight):
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    nodes = [
+        helper.make_node('Cast', [input_name], ['x'], to=TensorProto.FLOAT),
+        helper.make_node('Flatten', ['x'], ['flat']),
+        helper.make_node('MatMul', ['flat', 'weight'], ['output']),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        'linear',
+        [helper.make_tensor_value_info(input_name, input_type, input_shape)],
+        [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['N', 16])],
+        initializer=[numpy_helper.from_array(weight, 'weight')],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+
+def test_onnx_quantize(tmpdir, monkeypatch):
+    from onnx import TensorProto
+    from clip_server.model.clip_onnx import CLIPOnnxModel
+
+    monkeypatch.setenv('HOME', str(tmpdir))
+    model_dir = tmpdir.mkdir('model')
+    rng = np.random.RandomState(0)
+    _save_linear_onnx(
+        str(model_dir.join('visual.onnx')),
+        'pixel_values',
+        ['N', 3, 8, 8],
+        TensorProto.FLOAT,
+        rng.randn(192, 16).astype(np.float32),
+    )
+    _save_linear_onnx(
+        str(model_dir.join('textual.onnx')),
+        'input_ids',
+        ['N', 77],
+        TensorProto.INT32,
+        rng.randn(77, 16).astype(np.float32) / 100,
+    )
+
+    image_input = {'pixel_values': rng.rand(4, 3, 8, 8).astype(np.float32)}
+    text_input = {'input_ids': rng.randint(0, 1000, (4, 77)).astype(np.int32)}
+
+    model = CLIPOnnxModel('ViT-B-32::openai', str(model_dir))
+    model.start_sessions(providers=['CPUExecutionProvider'])
+    image_embeddings = model.encode_image(image_input)
+    text_embeddings = model.encode_text(text_input)
+
+    quantized = CLIPOnnxModel('ViT-B-32::openai', str(model_dir))
+    quantized.quantize()
+    assert quantized._visual_path.startswith(str(tmpdir.join('.cache', 'clip')))
+    quantized.start_sessions(providers=['CPUExecutionProvider'])
+
+    for expected, actual in (
+        (image_embeddings, quantized.encode_image(image_input)),
+        (text_embeddings, quantized.encode_text(text_input)),
+    ):
+        assert actual.shape == expected.shape
+        np.testing.assert_allclose(actual, expected, atol=0.05 * np.abs(expected).max())
@@ -1,9 +1,14 @@
 import os
 
 import pytest
-from clip_server.model.clip import _transform_ndarray, _transform_blob
+from clip_server.executors.helper import preproc_image
+from clip_server.model.clip import (
+    _transform_ndarray,
+    _transform_ndarray_crop,
+    _transform_blob,
+)
 from clip_server.model.pretrained_models import download_model
-from docarray import Document
+from docarray import Document, DocumentArray
 from jina import Flow
 import numpy as np
 
@@ -113,3 +118,26 @@ def test_server_preprocess_ndarray_image(image_uri, size):
 def test_transform_arbitrary_tensor(tensor):
     d = Document(tensor=tensor)
     assert _transform_ndarray(224)(d.tensor).numpy().shape == (3, 224, 224)
+
+
+@pytest.mark.parametrize(
+    'tensor',
+    [
+        np.random.random([100, 100, 3]),
+        np.random.random([1, 1, 3]),
+        np.random.random([5, 50, 3]),
+        np.random.randint(0, 256, [100, 80, 3], dtype=np.uint8),
+    ],
+)
+@pytest.mark.parametrize('return_np', [True, False])
+def test_preproc_image_batch(tensor, return_np):
+    da = DocumentArray([Document(tensor=tensor) for _ in range(3)])
+    _, batch = preproc_image(
+        da, preprocess_fn=_transform_ndarray_crop(224), return_np=return_np
+    )
+    pixel_values = np.asarray(batch['pixel_values'])
+    assert pixel_values.shape == (3, 3, 224, 224)
+    assert pixel_values.dtype == np.float32
+    np.testing.assert_allclose(
+        pixel_values[0], _transform_ndarray(224)(tensor).numpy(), atol=1e-5
+    )
@@ -27,6 +27,25 @@ def test_protocols(port_generator, protocol, jit, pytestconfig):
         c.profile(content=f'{pytestconfig.rootdir}/tests/img/00000.jpg')
 
 
+@pytest.mark.parametrize('batch_timeout_ms', [None, 10])
+def test_batch_timeout(port_generator, batch_timeout_ms, pytestconfig):
+    from clip_server.executors.clip_torch import CLIPEncoder
+
+    f = Flow(port=port_generator()).add(
+        uses=CLIPEncoder, uses_with={'batch_timeout_ms': batch_timeout_ms}
+    )
+    with f:
+        c = Client(server=f'grpc://0.0.0.0:{f.port}')
+        r = c.encode(
+            [
+                'hello, world',
+                f'{pytestconfig.rootdir}/tests/img/00000.jpg',
+                'goodbye, world',
+            ]
+        )
+        assert r.shape == (3, 512)
+
+
 @pytest.mark.parametrize(
     'inputs',
     [
@@ -15,3 +15,24 @@ def test_tokenizer_name(name):
     result = tokenizer(['hello world', 'welcome to the world'])
     assert result['input_ids'].shape == result['attention_mask'].shape
     assert result['input_ids'].shape[0] == 2
+
+
+@pytest.mark.parametrize(
+    'texts, context_length',
+    [
+        (['hello world'], 8),
+        (['hello world', 'welcome to the world'], 8),
+        (['hello world ' * 5], 16),
+        (['hello world ' * 50], 77),
+    ],
+)
+def test_tokenizer_pad_to_longest(texts, context_length):
+    tokenizer = Tokenizer('ViT-B-32::openai')
+
+    full = tokenizer(texts)
+    result = tokenizer(texts, pad_to_longest=True)
+    assert result['input_ids'].shape == (len(texts), context_length)
+    assert (result['input_ids'] == full['input_ids'][:, :context_length]).all()
+    assert (
+        result['attention_mask'] == full['attention_mask'][:, :context_length]
+    ).all()